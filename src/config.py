@@ -1,4 +1,5 @@
 from pathlib import Path
+from types import MappingProxyType
 
 # ==============================================================================
 # 1. PATHS
@@ -12,6 +13,9 @@ DATA_DIR = ROOT_DIR / "data" / "raw"
 # Suffixes: 2011-12 (_G), 2013-14 (_H), 2015-16 (_I), 2017-18 (_J)
 CYCLES = ["_G", "_H", "_I", "_J"]
 
+# PHQ-9 screener items: DPQ010...DPQ090 (DPQ100 is the functional-impact item)
+DPQ_ITEMS = tuple(f"DPQ0{i}0" for i in range(1, 10))
+
 NHANES_MAP = {
     # --- Demographics ---
     "DEMO": [
@@ -28,8 +32,7 @@ NHANES_MAP = {
         "RIDRETH3",
     ],
     # --- Questionnaire ---
-    "DPQ": ["SEQN"]
-    + [f"DPQ0{i}0" for i in range(1, 10)],  # Generates DPQ010...DPQ090
+    "DPQ": ["SEQN", *DPQ_ITEMS],
     "HSQ": ["SEQN", "HSD010"],
     "SMQ": ["SEQN", "SMQ020"],
     "ALQ": ["SEQN", "ALQ111"],
@@ -359,21 +362,24 @@ NUMERICAL_COLS = [
 ]
 
 
+# Refused (7) / Don't Know (9): one shared tuple for every 1-5 / Yes-No item
+_SEVEN_NINE = (7, 9)
+
 categorical_missing_codes = {
     # --- Demographics ---
-    "Education_Level": [7, 9],  # Scale 1-5
-    "Marital_Status": [77, 99],  # Note: Double-digit codes here
+    "Education_Level": _SEVEN_NINE,  # Scale 1-5
+    "Marital_Status": (77, 99),  # Note: Double-digit codes here
     # --- Lifestyle & History ---
-    "General_Health_Cond": [7, 9],  # Scale 1-5
-    "Vigorous_Activity": [7, 9],  # 1=Yes, 2=No
-    "100_Cigs_Lifetime": [7, 9],  # 1=Yes, 2=No
-    "Alcohol_Tried": [7, 9],  # 1=Yes, 2=No
-    "Trouble_Sleeping_Doc": [7, 9],  # 1=Yes, 2=No
+    "General_Health_Cond": _SEVEN_NINE,  # Scale 1-5
+    "Vigorous_Activity": _SEVEN_NINE,  # 1=Yes, 2=No
+    "100_Cigs_Lifetime": _SEVEN_NINE,  # 1=Yes, 2=No
+    "Alcohol_Tried": _SEVEN_NINE,  # 1=Yes, 2=No
+    "Trouble_Sleeping_Doc": _SEVEN_NINE,  # 1=Yes, 2=No
+    # --- Depression Screener Questions (DPQ) ---
+    # These are 0-3 scales. Codes 7 and 9 must be removed to prevent
+    # calculating an artificially high depression score.
+    **{col: _SEVEN_NINE for col in DPQ_ITEMS},
 }
 
-# --- Append Depression Screener Questions (DPQ) ---
-# These are 0-3 scales. Codes 7 and 9 must be removed to prevent
-# calculating an artificially high depression score.
-for i in range(1, 10):
-    col_name = f"DPQ0{i}0"  # Generates DPQ010, DPQ020...
-    categorical_missing_codes[col_name] = [7, 9]
+# Read-only view: the pipeline only ever looks codes up
+categorical_missing_codes = MappingProxyType(categorical_missing_codes)
@@ -1,7 +1,10 @@
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from loguru import logger
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Cycle mapping: Start Year -> Suffix
 CYCLES = {
@@ -39,12 +42,48 @@ COMPONENTS = {
 
 DEST_DIR = Path("data/raw")
 
+MAX_WORKERS = 16
+CHUNK_SIZE = 1 << 20  # 1 MiB read/write blocks for streamed downloads
+
+# Shared session: keep-alive connections to wwwn.cdc.gov are reused across threads
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=MAX_WORKERS,
+        pool_maxsize=MAX_WORKERS,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    ),
+)
+
 def get_base_url(component_type: str, year: int) -> str:
     """Returns the correct CDC URL for the given component and year."""
     # Logic: 2017-2018 -> 2017, 2011-2012 -> 2011 in URL path
     # URL structure: https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/{start_year}/DataFiles/
     return f"https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/{year}/DataFiles/"
 
+def _stream_to_disk(url: str, dest_path: Path) -> int:
+    """
+    Streams the response body to disk in CHUNK_SIZE blocks via a .part file,
+    renamed into place only once complete (removed if the transfer fails).
+    Returns the HTTP status code.
+    """
+    with SESSION.get(url, timeout=30, stream=True) as response:
+        if response.status_code != 200:
+            return response.status_code
+
+        part_path = dest_path.with_suffix(".part")
+        try:
+            with open(part_path, "wb", buffering=CHUNK_SIZE) as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(part_path, dest_path)
+        except BaseException:
+            # Don't leave a truncated .part file behind in data/raw
+            part_path.unlink(missing_ok=True)
+            raise
+        return response.status_code
+
 def download_file(filename: str, year: int, component_type: str):
     url = f"{get_base_url(component_type, year)}{filename}"
     dest_path = DEST_DIR / filename
@@ -56,21 +95,17 @@ def download_file(filename: str, year: int, component_type: str):
     logger.info(f"Downloading {filename} from {url}...")
     
     try:
-        response = requests.get(url, timeout=30)
-        if response.status_code == 200:
-            with open(dest_path, "wb") as f:
-                f.write(response.content)
+        status = _stream_to_disk(url, dest_path)
+        if status == 200:
             logger.success(f"Downloaded {filename}")
         else:
             url_lower = url.lower()
             logger.warning(f"Failed. Retrying with lowercase URL: {url_lower}")
-            response = requests.get(url_lower, timeout=30)
-            if response.status_code == 200:
-                with open(dest_path, "wb") as f:
-                    f.write(response.content)
+            status = _stream_to_disk(url_lower, dest_path)
+            if status == 200:
                 logger.success(f"Downloaded {filename}")
             else:
-                 logger.error(f"Failed to download {filename}. Status: {response.status_code}")
+                 logger.error(f"Failed to download {filename}. Status: {status}")
 
     except Exception as e:
         logger.error(f"Error downloading {filename}: {e}")
@@ -80,12 +115,17 @@ def main():
         os.makedirs(DEST_DIR)
         logger.info(f"Created directory: {DEST_DIR}")
 
+    tasks = []
     for year, suffix in CYCLES.items():
-        logger.info(f"--- Processing Cycle {year}-{year+1} (Suffix: {suffix}) ---")
+        logger.info(f"--- Queueing Cycle {year}-{year+1} (Suffix: {suffix}) ---")
         
         for component, comp_type in COMPONENTS.items():
             filename = f"{component}{suffix}.XPT"
-            download_file(filename, year, comp_type)
+            tasks.append((filename, year, comp_type))
+
+    # Downloads are network-bound: run them concurrently over the pooled session
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(lambda task: download_file(*task), tasks))
 
 if __name__ == "__main__":
     main()
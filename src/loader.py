@@ -1,117 +1,263 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import pandas as pd
 
+try:
+    import pyreadstat
+except ImportError:  # Optional: falls back to pandas' read-everything XPORT reader
+    pyreadstat = None
+
 from src import config
 # Lazy import to avoid circular dependency if possible, or just import here
 from src import preprocessing
 
 
-def find_file(filename_key: str) -> Path:
+def _build_xpt_index() -> dict:
     """
-    Case-insensitive search for .xpt files in DATA_DIR.
+    Walks DATA_DIR once and maps lowercase file stems to .xpt paths.
+    Built per load call (not per process), so files added later are picked up.
+    """
+    index = {}
+    if not config.DATA_DIR.exists():
+        # Empty for this call only; nothing is cached, so the next load re-walks
+        return index
+
+    # Breadth-first os.scandir walk: DirEntry caches the stat type info,
+    # and top-level files are seen (and win) before nested copies.
+    pending = [config.DATA_DIR]
+    while pending:
+        subdirs = []
+        for directory in pending:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        stem, _, ext = entry.name.rpartition(".")
+                        if ext.lower() == "xpt":
+                            index.setdefault(stem.lower(), Path(entry.path))
+        pending = subdirs
+    return index
+
+
+def _raw_data_fingerprint(index: dict) -> str:
+    """
+    Hashes name, size and mtime of every raw .xpt file, plus the column schema
+    in config. Used to invalidate caches when the input data or mapping changes.
+
+    Args:
+        index: A fresh _build_xpt_index() result, so files added since the
+            last load are part of the hash.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((config.CYCLES, config.NHANES_MAP, config.RENAME_MAP)).encode())
+    for key, path in sorted(index.items()):
+        stat = path.stat()
+        digest.update(f"{key}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+def _cache_is_fresh(cache_path: Path, fingerprint: str) -> bool:
+    """
+    True if the .sha sidecar next to cache_path matches the given fingerprint.
     """
-    target_name = filename_key.lower()
+    fingerprint_path = cache_path.with_suffix(".sha")
+    return (
+        fingerprint_path.exists()
+        and fingerprint_path.read_text().strip() == fingerprint
+    )
 
+
+def find_file(filename_key: str, index: dict = None) -> Path:
+    """
+    Case-insensitive search for .xpt files in DATA_DIR.
+
+    Args:
+        index: A _build_xpt_index() result to reuse; walks DATA_DIR if None.
+    """
     if not config.DATA_DIR.exists():
         raise FileNotFoundError(
             f"CRITICAL: Data directory not found at {config.DATA_DIR}"
         )
 
-    # 1. Try exact match (fastest)
-    exact_path = config.DATA_DIR / f"{filename_key}.XPT"
-    if exact_path.exists():
-        return exact_path
+    if index is None:
+        index = _build_xpt_index()
+    return index.get(filename_key.lower())
+
+
+def _read_xpt(path: Path, columns: list) -> pd.DataFrame:
+    """
+    Reads only the requested columns (those present in the file) from an XPT file.
+    Uses pyreadstat's column pushdown when installed, pandas otherwise.
+    """
+    df = None
+    if pyreadstat is not None:
+        try:
+            _, meta = pyreadstat.read_xport(str(path), metadataonly=True)
+            file_cols = set(meta.column_names)
+            usecols = [c for c in columns if c in file_cols]
+            df, _ = pyreadstat.read_xport(str(path), usecols=usecols)
+            # pyreadstat returns file order; keep the requested order
+            df = df[usecols]
+        except (pyreadstat.PyreadstatError, pyreadstat.ReadstatError) as e:
+            print(f"      [WARNING] pyreadstat failed on {path.name} ({e}). Using pandas.")
+            df = None
 
-    # 2. Recursive search (robust)
-    for file_path in config.DATA_DIR.rglob("*"):
-        if (
-            file_path.is_file()
-            and file_path.stem.lower() == target_name
-            and file_path.suffix.lower() == ".xpt"
-        ):
-            return file_path
+    if df is None:
+        df = pd.read_sas(str(path))
+        df = df[[c for c in columns if c in df.columns]]
 
-    return None
+    # Values stay float64: rounding KNN inputs to float32 flips near-tied donors
+    return df
 
 
-def load_cycle(suffix: str) -> pd.DataFrame:
+def _read_aux(path: Path, requested_cols: list) -> pd.DataFrame:
     """
-    Loads one specific NHANES cycle (e.g., 2017-2018 with suffix '_J').
+    Reads one auxiliary XPT file and keeps the requested columns (+ SEQN).
+    Returns None if the file holds none of the requested columns.
+    """
+    # Ensure SEQN is present for merging
+    columns = list(requested_cols)
+    if "SEQN" not in columns:
+        columns.append("SEQN")
+
+    aux = _read_xpt(path, columns)
+
+    if len(aux.columns) <= 1: 
+        # Only SEQN or empty
+        return None
+
+    # SEQN tops out around 125k, so uint32 halves the join key vs int64
+    aux["SEQN"] = aux["SEQN"].astype("uint32")
+    # One row per participant keeps the SEQN join one-to-one (no row blow-up)
+    return aux.drop_duplicates("SEQN")
+
+
+def _max_workers(n_tasks: int) -> int:
+    """
+    Worker count for XPT parsing: bounded by cores, a hard cap and the task count.
+    """
+    return max(1, min(8, os.cpu_count() or 1, n_tasks))
+
+
+def _submit_cycle(suffix: str, executor: ProcessPoolExecutor, index: dict) -> dict:
+    """
+    Queues every XPT read of one cycle on the executor.
+    Returns {map_key: future} (DEMO first), or None if the backbone is missing.
     """
     print(f"   -> Loading Cycle {suffix}...")
     
     # 1. Load Backbone (Demographics)
     demo_key = f"DEMO{suffix}"
-    demo_path = find_file(demo_key)
+    demo_path = find_file(demo_key, index)
     
     if not demo_path:
         print(f"      [SKIP] Backbone {demo_key} not found.")
-        return pd.DataFrame() # Empty DF if no backbone
+        return None
 
-    # Load and clean DEMO
-    df = pd.read_sas(str(demo_path))
-    
-    # Select cols based on GENERIC key "DEMO"
-    target_cols = config.NHANES_MAP["DEMO"]
-    available_demo = [c for c in target_cols if c in df.columns]
-    df = df[available_demo]
-    df["SEQN"] = df["SEQN"].astype(int)
-
-    # 2. Merge Auxiliary Files
-    for key, requested_cols in config.NHANES_MAP.items():
+    # Load DEMO (cols based on GENERIC key "DEMO")
+    futures = {"DEMO": executor.submit(_read_xpt, demo_path, config.NHANES_MAP["DEMO"])}
+
+    # 2. Read Auxiliary Files (in worker processes, XPT parsing holds the GIL)
+    for key in config.NHANES_MAP:
         if key == "DEMO":
             continue
 
-        file_key = f"{key}{suffix}"
-        path = find_file(file_key)
-
+        path = find_file(f"{key}{suffix}", index)
         if path:
-            aux = pd.read_sas(str(path))
+            futures[key] = executor.submit(_read_aux, path, config.NHANES_MAP[key])
+
+        # We don't print missing files per cycle to avoid spam, 
+        # unless it's a critical debugging session.
 
-            # Get columns that actually exist in the file
-            available_cols = [c for c in requested_cols if c in aux.columns]
+    return futures
 
-            # Ensure SEQN is present for merging
-            if "SEQN" not in available_cols and "SEQN" in aux.columns:
-                available_cols.append("SEQN")
 
-            if len(available_cols) <= 1: 
-                # Only SEQN or empty
-                continue
+def _assemble_cycle(suffix: str, futures: dict) -> pd.DataFrame:
+    """
+    Collects the reads queued by _submit_cycle and joins them on SEQN.
+    """
+    if futures is None:
+        return pd.DataFrame() # Empty DF if no backbone
 
-            aux = aux[available_cols]
-            aux["SEQN"] = aux["SEQN"].astype(int)
+    df = futures["DEMO"].result()
+    df["SEQN"] = df["SEQN"].astype("uint32")
 
-            # Merge
-            df = pd.merge(df, aux, on="SEQN", how="left")
-        
-        # We don't print missing files per cycle to avoid spam, 
-        # unless it's a critical debugging session.
-        
-    if not df.columns.is_unique:
-        dupes = df.columns[df.columns.duplicated()].tolist()
-        print(f"      [ERROR] DUPLICATE COLUMNS in Cycle {suffix}: {dupes}")
-        # Attempt to deduplicate by keeping first
-        df = df.loc[:, ~df.columns.duplicated()]
+    # 3. Join everything on the SEQN index in one pass (NHANES_MAP order)
+    # join() refuses overlapping columns, so duplicates are resolved up front
+    seen_cols = set(df.columns)
+    aux_frames = []
+    for key, future in futures.items():
+        if key == "DEMO":
+            continue
+        aux = future.result()
+        if aux is None:
+            continue
+
+        dupes = [c for c in aux.columns if c != "SEQN" and c in seen_cols]
+        if dupes:
+            print(f"      [ERROR] DUPLICATE COLUMNS in Cycle {suffix} ({key}): {dupes}")
+            # Attempt to deduplicate by keeping first
+            aux = aux.drop(columns=dupes)
+        seen_cols.update(aux.columns)
+        aux_frames.append(aux.set_index("SEQN"))
+
+    if aux_frames:
+        df = df.set_index("SEQN").join(aux_frames, how="left").reset_index()
         
     return df
 
 
-def load_raw_data() -> pd.DataFrame:
+def load_cycle(suffix: str) -> pd.DataFrame:
+    """
+    Loads one specific NHANES cycle (e.g., 2017-2018 with suffix '_J').
+    """
+    index = _build_xpt_index()
+    with ProcessPoolExecutor(max_workers=_max_workers(len(config.NHANES_MAP))) as executor:
+        return _assemble_cycle(suffix, _submit_cycle(suffix, executor, index))
+
+
+def load_raw_data(use_cache: bool = True) -> pd.DataFrame:
     """
     Orchestrates the ETL process:
     1. Iterates through all cycles in config.CYCLES.
     2. Loads and merges data for each cycle.
     3. Concatenates all cycles into one big DataFrame.
+
+    Args:
+        use_cache: If True, returns the cached merged frame when the raw files are unchanged.
     """
+    cache_path = config.ROOT_DIR / "data" / "processed" / "nhanes_raw_2011_2018.pkl"
+    # One directory walk shared by the fingerprint and every find_file lookup
+    index = _build_xpt_index()
+    fingerprint = _raw_data_fingerprint(index)
+
+    if use_cache and cache_path.exists() and _cache_is_fresh(cache_path, fingerprint):
+        try:
+            df = pd.read_pickle(cache_path)
+            print(f"--- Loaded cached raw data from {cache_path}. Shape: {df.shape} ---")
+            return df
+        except Exception as e:
+            print(f"   [WARNING] Raw cache load failed ({e}). Reloading XPT files...")
+
     print(f"--- STARTING DATA INGESTION from {config.DATA_DIR} ---")
     
     all_cycles_dfs = []
-    
-    for suffix in config.CYCLES:
-        cycle_df = load_cycle(suffix)
-        if not cycle_df.empty:
+
+    # Queue every file of every cycle up front so one pool stays busy across cycles
+    n_files = len(config.CYCLES) * len(config.NHANES_MAP)
+    with ProcessPoolExecutor(max_workers=_max_workers(n_files)) as executor:
+        pending = {
+            suffix: _submit_cycle(suffix, executor, index) for suffix in config.CYCLES
+        }
+
+        for suffix, futures in pending.items():
+            cycle_df = _assemble_cycle(suffix, futures)
+            if cycle_df.empty:
+                continue
             print(f"      -> Cycle {suffix} loaded. Shape: {cycle_df.shape}")
             all_cycles_dfs.append(cycle_df)
     
@@ -121,6 +267,14 @@ def load_raw_data() -> pd.DataFrame:
     final_df = pd.concat(all_cycles_dfs, axis=0, ignore_index=True)
     
     print(f"--- DATA LOADING COMPLETE. Final Shape: {final_df.shape} (Unique SEQN: {final_df['SEQN'].nunique()}) ---")
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        final_df.to_pickle(cache_path)
+        cache_path.with_suffix(".sha").write_text(fingerprint)
+    except Exception as e:
+        print(f"   [WARNING] Could not save raw cache: {e}")
+
     return final_df
 
 
@@ -133,29 +287,36 @@ def load_processed_data(force_reload: bool = False) -> pd.DataFrame:
         force_reload: If True, ignores cache and rebuilds from scratch.
     """
     cache_path = config.ROOT_DIR / "data" / "processed" / "nhanes_final_2011_2018.pkl"
+    # Sidecar holding the fingerprint of the raw files the cache was built from
+    fingerprint_path = cache_path.with_suffix(".sha")
+    fingerprint = _raw_data_fingerprint(_build_xpt_index())
     
     # Create processed directory if it doesn't exist
     if not cache_path.parent.exists():
         cache_path.parent.mkdir(parents=True, exist_ok=True)
-        
+
     if cache_path.exists() and not force_reload:
-        print(f"🚀 Loading Cached Data from {cache_path}...")
-        try:
-            df = pd.read_pickle(cache_path)
-            print(f"   -> Success! Loaded {len(df)} rows. (Time saved: ~4 mins)")
-            return df
-        except Exception as e:
-            print(f"   [WARNING] Cache load failed ({e}). Rebuilding...")
+        if not _cache_is_fresh(cache_path, fingerprint):
+            print("   [INFO] Raw data changed since the cache was built. Rebuilding...")
+        else:
+            print(f"🚀 Loading Cached Data from {cache_path}...")
+            try:
+                df = pd.read_pickle(cache_path)
+                print(f"   -> Success! Loaded {len(df)} rows. (Time saved: ~4 mins)")
+                return df
+            except Exception as e:
+                print(f"   [WARNING] Cache load failed ({e}). Rebuilding...")
             
     # Rebuild Pipeline
     print("⚙️  Cache miss or force reload. Running Full Data Pipeline...")
-    df_raw = load_raw_data()
-    df = preprocessing.run_full_preprocessing(df_raw)
+    df_raw = load_raw_data(use_cache=not force_reload)
+    df = preprocessing.run_full_preprocessing(df_raw, use_cache=not force_reload)
     
     # Save to Cache
     try:
         print(f"💾 Saving processed data to {cache_path}...")
         df.to_pickle(cache_path)
+        fingerprint_path.write_text(fingerprint)
     except Exception as e:
         print(f"   [WARNING] Could not save cache: {e}")
         